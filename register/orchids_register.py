@@ -3,23 +3,36 @@ import time
 import random
 import string
 import re
-import shutil
 import requests
 import html
+import traceback
+import atexit
+from collections import OrderedDict
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
-import undetected_chromedriver as uc
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+# selenium / undetected_chromedriver 导入较重, 推迟到真正需要浏览器时再加载
 
 # ================= 配置区 =================
 MAIL_API = "https://mail.chatgpt.org.uk"
 MAIL_KEY = "gpt-test"  
 OUTPUT_FILE = os.path.abspath("orchids_accounts.txt")
 TARGET_URL = "https://www.orchids.app/"
+CODE_TIMEOUT = 120  # 等待验证码的最长时间 (秒)
+POLL_DELAYS = [1, 1, 2, 2, 3, 5, 5, 8]  # 邮箱轮询间隔, 用完后保持最后一个值
+MAX_PROCESSED_IDS = 64  # 已处理邮件 ID 的缓存上限
+KEYS_FLUSH_EVERY = 5  # 每累计多少个 Key 写一次 OUTPUT_FILE
+DEBUG = os.environ.get("ORCHIDS_DEBUG") == "1"  # 输出调试日志 (如 Cookie 明细)
+# 页面加载时屏蔽的第三方统计请求. Network.setBlockedURLs 只按 URL 通配匹配, 无法排除域名,
+# 因此只用按主机名的规则, 不要加入 *.png / *.woff2 之类的扩展名规则, 否则会波及
+# challenges.cloudflare.com / clerk 的资源.
+BLOCKED_URLS = [
+    "*google-analytics*", "*googletagmanager*", "*doubleclick*", "*segment.io*",
+]
+
+OTP_RE = re.compile(r'(?<!\d)(\d{6})(?!\d)')  # 严格匹配独立的6位数字
+TAG_RE = re.compile(r'<[^>]+>')
+WS_RE = re.compile(r'\s+')
 
 # ================= 工具函数 =================
 
@@ -37,6 +50,20 @@ def create_http_session():
 
 http = create_http_session()
 
+collected_keys = []  # 尚未写入 OUTPUT_FILE 的 Key
+
+def flush_collected_keys():
+    """将缓存的 Key 一次性追加写入 OUTPUT_FILE 并落盘"""
+    if not collected_keys:
+        return
+    with open(OUTPUT_FILE, "a", buffering=1 << 16) as f:
+        f.writelines(f"{k}\n" for k in collected_keys)
+        f.flush()
+        os.fsync(f.fileno())
+    collected_keys.clear()
+
+atexit.register(flush_collected_keys)  # 异常退出时写入剩余的 Key
+
 def generate_password():
     chars = string.ascii_letters + string.digits + "!@#$%"
     return ''.join(random.choice(chars) for _ in range(14))
@@ -74,12 +101,12 @@ def create_temp_email():
     return None
 
 def wait_for_code(email):
-    log(f"📩 正在监听 {email} 的收件箱 (120s)...")
+    log(f"📩 正在监听 {email} 的收件箱 ({CODE_TIMEOUT}s)...")
     start = time.time()
-    processed_ids = set()
-    regex_strict = r'(?<!\d)(\d{6})(?!\d)' # 严格匹配独立的6位数字
+    processed_ids = OrderedDict()
+    attempt = 0
     
-    while time.time() - start < 120:
+    while time.time() - start < CODE_TIMEOUT:
         try:
             r = http.get(f"{MAIL_API}/api/emails", params={"email": email}, headers={"X-API-Key": MAIL_KEY}, timeout=10)
             data = r.json().get('data', {}).get('emails', [])
@@ -89,32 +116,41 @@ def wait_for_code(email):
                 email_id = latest_email.get('id')
                 
                 if email_id not in processed_ids:
-                    processed_ids.add(email_id)
+                    processed_ids[email_id] = True
+                    if len(processed_ids) > MAX_PROCESSED_IDS:
+                        processed_ids.popitem(last=False)
                     subject = latest_email.get('subject', '')
                     raw_content = latest_email.get('content') or latest_email.get('html_content') or ''
                     
                     # HTML 清洗
                     text_content = html.unescape(raw_content)
-                    text_content = re.sub(r'<[^>]+>', ' ', text_content)
-                    text_content = re.sub(r'\s+', ' ', text_content).strip()
+                    text_content = TAG_RE.sub(' ', text_content)
+                    text_content = WS_RE.sub(' ', text_content).strip()
                     
                     log(f"📨 收到新邮件: {subject}")
                     
                     # 匹配验证码
                     for source in [subject, text_content]:
-                        match = re.search(regex_strict, source)
+                        match = OTP_RE.search(source)
                         if match:
                             code = match.group(1)
                             log(f"✅ 提取到验证码: {code}")
                             return code
-            
-            time.sleep(3)
         except: pass
+
+        # 自适应间隔: 邮件通常很快到达, 前期密集轮询, 之后逐渐放缓以减少请求数
+        delay = POLL_DELAYS[min(attempt, len(POLL_DELAYS) - 1)]
+        attempt += 1
+        remaining = CODE_TIMEOUT - (time.time() - start)
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
             
     return None
 
 def force_inject_turnstile(driver):
     """暴力且持续地尝试点击 Cloudflare 验证框"""
+    from selenium.webdriver.common.by import By
     try:
         # 先尝试在主文档中寻找可能外露的验证元素
         js_find_and_click = """
@@ -166,6 +202,125 @@ def force_inject_turnstile(driver):
         log(f"暴力点击执行异常: {e}", "WARN")
     return False
 
+def list_processes():
+    """通过 CIM 查询当前进程, 返回 {pid: (ppid, 创建时间)}"""
+    import subprocess
+    script = ("Get-CimInstance Win32_Process | ForEach-Object { "
+              "'{0} {1} {2}' -f $_.ProcessId, $_.ParentProcessId, $_.CreationDate.Ticks }")
+    out = subprocess.run(["powershell", "-NoProfile", "-Command", script],
+                         capture_output=True, text=True).stdout
+    procs = {}
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and all(p.isdigit() for p in parts):
+            procs[int(parts[0])] = (int(parts[1]), int(parts[2]))
+    return procs
+
+def close_driver(driver):
+    """退出浏览器, 并只清理本实例浏览器进程树中残留的进程"""
+    browser_pid = getattr(driver, 'browser_pid', None)
+    tree = {}
+    if browser_pid:
+        # quit() 之前先记录整棵进程树, quit() 后父进程已退出就找不到子进程了
+        try:
+            procs = list_processes()
+        except Exception:
+            procs = {}
+        if browser_pid in procs:
+            tree[browser_pid] = procs[browser_pid][1]
+            changed = True
+            while changed:
+                changed = False
+                for pid, (ppid, created) in procs.items():
+                    if pid not in tree and ppid in tree and created >= tree[ppid]:
+                        tree[pid] = created
+                        changed = True
+
+    try:
+        driver.quit()
+    except: pass
+
+    if tree:
+        import subprocess
+        try:
+            alive = list_processes()
+        except Exception:
+            return
+        for pid, created in tree.items():
+            # 创建时间一致才是同一个进程, 不会误杀复用了该 PID 的其他进程
+            if alive.get(pid, (None, None))[1] == created:
+                subprocess.run(["taskkill", "/f", "/pid", str(pid)], capture_output=True)
+
+WAIT_FOR_ELEMENT_JS = """
+const [kind, sel, visible, timeoutMs] = arguments;
+const done = arguments[arguments.length - 1];
+function find() {
+    let nodes = [];
+    if (kind === 'xpath') {
+        let snap = document.evaluate(sel, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+        for (let i = 0; i < snap.snapshotLength; i++) nodes.push(snap.snapshotItem(i));
+    } else {
+        nodes = document.querySelectorAll(sel);
+    }
+    for (let el of nodes) {
+        if (!visible || isShown(el)) return el;
+    }
+    return null;
+}
+// 近似 Selenium 的 is_displayed + is_enabled
+function isShown(el) {
+    if (el.disabled) return false;
+    let rect = el.getBoundingClientRect();
+    if (rect.width === 0 || rect.height === 0) return false;
+    let style = getComputedStyle(el);
+    return style.visibility !== 'hidden' && style.visibility !== 'collapse' && style.opacity !== '0';
+}
+let el = find();
+if (el) return done(el);
+let timer, expiry;
+function stop() { obs.disconnect(); clearInterval(timer); clearTimeout(expiry); }
+function check() {
+    let el = find();
+    if (el) { stop(); done(el); }
+}
+const obs = new MutationObserver(check);
+obs.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+// 兜底: 纯样式变化 (如 CSS 过渡) 不会触发 MutationObserver
+timer = setInterval(check, 500);
+// 在 Selenium 脚本超时前自行清理, 避免超时后观察器继续在页面里运行
+expiry = setTimeout(stop, Math.max(timeoutMs - 50, 0));
+"""
+
+# 页面跳转导致异步脚本中断时 chromedriver 返回的错误信息
+NAVIGATION_ERRORS = ("document unloaded", "execution context was destroyed", "cannot find context", "target navigated")
+
+def wait_for_element(driver, selector, timeout=20, by="css", visible=True):
+    """在页面内用 MutationObserver 等待元素出现, 每次等待只需一次 WebDriver 调用.
+
+    by 为 "css" 或 "xpath"; visible=True 时要求元素可见且未禁用 (近似 element_to_be_clickable).
+    """
+    from selenium.common.exceptions import JavascriptException, ScriptTimeoutException, TimeoutException
+    deadline = time.time() + timeout
+    prev_timeout = driver.timeouts.script
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutException(f"等待元素超时: {selector}")
+            driver.set_script_timeout(remaining)
+            try:
+                return driver.execute_async_script(WAIT_FOR_ELEMENT_JS, by, selector, visible, int(remaining * 1000))
+            except ScriptTimeoutException:
+                raise TimeoutException(f"等待元素超时: {selector}")
+            except JavascriptException as e:
+                # 只有页面跳转中断脚本时才在新文档上重新等待, 选择器错误等直接抛出
+                if not any(m in (e.msg or '').lower() for m in NAVIGATION_ERRORS):
+                    raise
+                time.sleep(0.2)
+    finally:
+        # 恢复会话级脚本超时, 避免影响后续的 execute_script
+        driver.set_script_timeout(prev_timeout)
+
 # ================= 单次注册任务逻辑 =================
 
 def register_one_account(current_idx, total_count):
@@ -175,6 +330,9 @@ def register_one_account(current_idx, total_count):
     if not email:
         return False
 
+    import undetected_chromedriver as uc
+    from selenium.webdriver.common.by import By
+
     options = uc.ChromeOptions()
     options.binary_location = r"C:\Program Files\Google\Chrome\Application\chrome.exe"
     options.add_argument("--disable-blink-features=AutomationControlled")
@@ -183,7 +341,11 @@ def register_one_account(current_idx, total_count):
     driver_path = r"C:\Users\Y\AppData\Roaming\undetected_chromedriver\chromedriver-win64\chromedriver.exe"
     driver = uc.Chrome(options=options, use_subprocess=True, driver_executable_path=driver_path)
     driver.set_window_size(800, 900)
-    wait = WebDriverWait(driver, 20)
+    try:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URLS})
+    except Exception as e:
+        log(f"资源屏蔽设置失败: {e}", "WARN")
 
     success = False
 
@@ -192,13 +354,13 @@ def register_one_account(current_idx, total_count):
         driver.get(TARGET_URL)
 
         # 1. 进入注册页
-        wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Sign in')] | //a[contains(text(), 'Sign in')]"))).click()
-        wait.until(EC.visibility_of_element_located((By.XPATH, "//*[contains(text(), 'Welcome back')]")))
-        sign_up_link = wait.until(EC.element_to_be_clickable((By.XPATH, "//a[contains(text(), 'Sign up')] | //button[contains(text(), 'Sign up')]")))
+        wait_for_element(driver, "//button[contains(text(), 'Sign in')] | //a[contains(text(), 'Sign in')]", by="xpath").click()
+        wait_for_element(driver, "//*[contains(text(), 'Welcome back')]", by="xpath")
+        sign_up_link = wait_for_element(driver, "//a[contains(text(), 'Sign up')] | //button[contains(text(), 'Sign up')]", by="xpath")
         driver.execute_script("arguments[0].click();", sign_up_link)
 
         # 2. 填写表单
-        wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, "input[name='emailAddress']")))
+        wait_for_element(driver, "input[name='emailAddress']")
             
         password = generate_password()
         driver.find_element(By.CSS_SELECTOR, "input[name='emailAddress']").send_keys(email)
@@ -225,12 +387,11 @@ def register_one_account(current_idx, total_count):
             
         if not pass_check:
             log("❌ 暴力过校验超时，跳过此账号", "ERR")
-            driver.quit()
             return False
 
         # 4. 验证码提取
         log("等待输入验证码...")
-        otp_input = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.CSS_SELECTOR, "input[inputmode='numeric']")))
+        otp_input = wait_for_element(driver, "input[inputmode='numeric']", timeout=10, visible=False)
         code = wait_for_code(email)
         
         if code:
@@ -241,7 +402,7 @@ def register_one_account(current_idx, total_count):
             # 用户名处理
             if "sign-up" in driver.current_url:
                 try:
-                    WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.NAME, "username")))
+                    wait_for_element(driver, "[name='username']", timeout=5, visible=False)
                     driver.find_element(By.NAME, "username").send_keys("User" + str(random.randint(1000, 9999)))
                     btns = driver.find_elements(By.TAG_NAME, "button")
                     for btn in btns:
@@ -260,31 +421,29 @@ def register_one_account(current_idx, total_count):
                 all_cookies = driver.get_cookies()
 
             log(f"--- 搜索到 {len(all_cookies)} 个全局 Cookie ---")
-            client_key = None
-            for cookie in all_cookies:
-                name = cookie.get('name')
-                domain = cookie.get('domain')
-                value = cookie.get('value')
-                
-                # 打印含有 client 关键字的 cookie 供参考
-                if 'client' in name.lower():
-                    log(f"发现相关 Cookie -> 名称: {name}, 域名: {domain}, 值预览: {value[:30]}...")
-
-                if name == '__client':
-                    client_key = value
-                    # 如果域名包含 clerk，说明找到了最准确的那个
-                    if 'clerk' in domain:
-                        log(f"🎯 精准命中 Clerk 域名的 __client")
+            if DEBUG:
+                for cookie in all_cookies:
+                    name = cookie.get('name', '')
+                    if 'client' in name.lower():
+                        log(f"发现相关 Cookie -> 名称: {name}, 域名: {cookie.get('domain')}, 值预览: {cookie.get('value', '')[:30]}...", "DEBUG")
+
+            # 优先取 Clerk 域名下的 __client, 那个最准确
+            clients = [c for c in all_cookies if c.get('name') == '__client']
+            clerk_client = next((c for c in clients if 'clerk' in c.get('domain', '')), None)
+            if clerk_client:
+                log(f"🎯 精准命中 Clerk 域名的 __client")
+            chosen = clerk_client or (clients[0] if clients else None)
+            client_key = chosen.get('value') if chosen else None
             
             if client_key:
                 log(f"✅ 成功提取 __client Key")
-                with open(OUTPUT_FILE, "a") as f:
-                    f.write(f"{client_key}\n")
+                collected_keys.append(client_key)
+                if len(collected_keys) >= KEYS_FLUSH_EVERY:
+                    flush_collected_keys()
                 
                 # 同步上传到服务器
                 upload_to_server(client_key)
 
-                driver.quit()
                 success = True
             else:
                 log("❌ 未能提取到 __client Key", "ERR")
@@ -293,15 +452,10 @@ def register_one_account(current_idx, total_count):
             log("❌ 验证码获取超时")
 
     except Exception as e:
-        import traceback
         log(f"❌ 注册流程出错: {e}")
         log(f"详细错误: {traceback.format_exc()}", "ERR")
     finally:
-        try:
-            driver.quit()
-        except: pass
-        import subprocess
-        subprocess.run("taskkill /f /im chrome.exe", shell=True, capture_output=True)
+        close_driver(driver)
 
     return success
 
@@ -323,6 +477,8 @@ if __name__ == "__main__":
             log(f"☕ 休息 {wait_time} 秒后继续...")
             time.sleep(wait_time)
 
+    flush_collected_keys()
+
     print(f"\n{'='*30}")
     print(f"任务结束！成功: {success_count}/{total_num}")
     print(f"数据已保存在: {OUTPUT_FILE}")